@@ -1,28 +1,39 @@
 import os
-import json
+import re
 import uuid
 import base64
+import secrets
+import hashlib
+import functools
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from datetime import datetime
-from urllib.parse import urlparse
 import stripe
 from flask import abort
 
 from flask import (
     Flask, render_template, request, jsonify, send_file,
-    send_from_directory, redirect, url_for, session, flash
+    send_from_directory, redirect, url_for, session, flash, g
 )
+from flask.json.provider import JSONProvider
+import orjson
 from dotenv import load_dotenv
 from authlib.integrations.flask_client import OAuth
 from werkzeug.utils import secure_filename
 
 # --- ДОБАВЛЕНО: SQLAlchemy ---
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
 # -----------------------------
 
-import qrcode
-from qrcode.image.pil import PilImage
-from qrcode.image.svg import SvgPathImage
+import numpy as np
+
+import segno
 
 from PIL import Image, ImageDraw, ImageFont, ImageFilter
 
@@ -32,7 +43,28 @@ load_dotenv()
 
 app = Flask(__name__, static_folder="static", template_folder="templates")
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "dev-secret")
+
+
+# orjson вместо стандартного json: base64-ответы /generate_qr — это
+# сотни КБ ASCII, которые stdlib-энкодер проходит посимвольно
+class _OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+app.json = _OrjsonProvider(app)
 stripe.api_key = os.environ.get("STRIPE_SECRET_KEY")
+# один keep-alive HTTP-клиент на все вызовы Stripe API: сессия requests
+# переиспользует соединение вместо TLS-хендшейка на каждый вызов
+stripe.default_http_client = stripe.RequestsClient()
+# читаем конфиг Stripe один раз на старте, а не на каждом запросе
+STRIPE_PUB_KEY = os.environ.get("STRIPE_PUBLISHABLE_KEY")
+STRIPE_WEBHOOK_SECRET = os.environ.get("STRIPE_WEBHOOK_SECRET")
+ONE_TIME_PRICE_CENTS = int(os.environ.get("ONE_TIME_PRICE_CENTS", 199))
+PRO_PRICE_ID = os.environ.get("STRIPE_PRO_MONTHLY_PRICE_ID")
 
 DATA_DIR = os.environ.get("DATA_DIR", os.path.join(os.getcwd(), "data"))
 os.makedirs(DATA_DIR, exist_ok=True)
@@ -44,42 +76,38 @@ os.makedirs(DYNAMIC_QR_DIR, exist_ok=True)
 DB_PATH = os.path.join(DATA_DIR, "site.db")
 app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{DB_PATH}"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# LIFO-пул: повторно берём самое «горячее» соединение — у него уже прогреты
+# page cache и mmap SQLite (pre_ping/recycle для локального файла не нужны)
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {"pool_use_lifo": True}
 db = SQLAlchemy(app)
-# ----------------------------------------
-
-DEBUG_MODE = os.environ.get("DEBUG_MODE", "false").lower() == "true"
 
-DYN_PATH = os.environ.get("DYN_PATH", os.path.join(DATA_DIR, "dynamic.json"))
-if not os.path.exists(DYN_PATH):
-    with open(DYN_PATH, "w", encoding="utf-8") as f:
-        json.dump({}, f)
 
-def _create_dynamic_entry(target_url: str) -> tuple[str, str]:
+@event.listens_for(Engine, "connect")
+def _set_sqlite_pragmas(dbapi_conn, _connection_record):
     """
-    Создаёт запись для Dynamic QR в DYN_PATH и возвращает (id, short_url).
+    WAL: писатель (создание ссылок, Stripe-вебхуки) больше не блокирует
+    читателей /r/<id>; synchronous=NORMAL убирает fsync на каждый commit.
     """
-    id_ = uuid.uuid4().hex[:8]
-
-    # читаем существующий JSON (или создаём новый)
-    with open(DYN_PATH, "r+", encoding="utf-8") as f:
-        try:
-            data = json.load(f)
-        except json.JSONDecodeError:
-            data = {}
+    if not type(dbapi_conn).__module__.startswith("sqlite3"):
+        return
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA cache_size=-20000")
+    cursor.close()
+# ----------------------------------------
 
-        data[id_] = {
-            "url": target_url,
-            "created": datetime.utcnow().isoformat()
-        }
+DEBUG_MODE = os.environ.get("DEBUG_MODE", "false").lower() == "true"
 
-        f.seek(0)
-        json.dump(data, f)
-        f.truncate()
-
-    # короткая ссылка вида https://colorqr.app/r/abcd1234
-    short = url_for("dynamic_redirect", id=id_, _external=True)
-    return id_, short
+# за nginx файлы можно отдавать через X-Sendfile: ядро делает sendfile(2),
+# а воркер освобождается сразу (включать только при настроенном фронте)
+app.use_x_sendfile = os.environ.get("USE_X_SENDFILE", "false").lower() == "true"
 
+# legacy: старые динамические коды из dynamic.json (только чтение —
+# все новые записи идут в DynamicLink)
+DYN_PATH = os.environ.get("DYN_PATH", os.path.join(DATA_DIR, "dynamic.json"))
 
 
 # Google OAuth (no passwords stored)
@@ -103,6 +131,11 @@ ALLOWED_ICON_EXT = {".png"}
 MAX_ICON_SIZE_BYTES = 512 * 1024
 MAX_ICON_DIM = 512
 
+# глобальный потолок тела запроса: Werkzeug сам отвечает 413, в том числе
+# для chunked-загрузок без Content-Length (самый большой легитимный
+# запрос — аплоад иконки)
+app.config["MAX_CONTENT_LENGTH"] = MAX_ICON_SIZE_BYTES * 2
+
 # ---------------------- МОДЕЛЬ DB ----------------------
 class UserStatus(db.Model):
     """
@@ -110,12 +143,13 @@ class UserStatus(db.Model):
     """
     id = db.Column(db.Integer, primary_key=True)
     # Используем нижний регистр для email
-    email = db.Column(db.String(120), unique=True, nullable=False)
+    email = db.Column(db.String(120), unique=True, index=True, nullable=False)
     has_one_time_access = db.Column(db.Boolean, default=False, nullable=False)
 
     is_sub_pro = db.Column(db.Boolean, default=False, nullable=False)
-    stripe_customer_id = db.Column(db.String(120), nullable=True)
-    stripe_subscription_id = db.Column(db.String(120), nullable=True)
+    # вебхуки Stripe фильтруют по этим колонкам — без индекса это full scan
+    stripe_customer_id = db.Column(db.String(120), nullable=True, index=True)
+    stripe_subscription_id = db.Column(db.String(120), nullable=True, index=True)
     subscription_status = db.Column(db.String(50), nullable=True)  # 'active', 'canceled', etc.
 
     def __repr__(self):
@@ -137,6 +171,25 @@ class DynamicLink(db.Model):
         return f"<DynamicLink {self.id} -> {self.target_url}>"
 
 
+class WebhookEvent(db.Model):
+    """
+    Обработанные события Stripe: защита от повторной доставки (ретраи).
+    """
+    id = db.Column(db.String(64), primary_key=True)  # evt_...
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+
+# под gunicorn db.create_all() из __main__ не выполняется, а таблица
+# появилась позже базовой схемы — досоздаём её на существующих базах
+with app.app_context():
+    WebhookEvent.__table__.create(db.engine, checkfirst=True)
+
+
+def _new_dynamic_id() -> str:
+    # 6 случайных байт → ровно 8 url-safe символов без паддинга
+    return base64.urlsafe_b64encode(secrets.token_bytes(6)).decode()
+
+
 def _create_dynamic_link_in_db(target_url: str, label: str | None = None) -> tuple[str, str]:
     """
     Создаёт запись DynamicLink в БД и возвращает (id, short_url).
@@ -149,13 +202,14 @@ def _create_dynamic_link_in_db(target_url: str, label: str | None = None) -> tup
     else:
         owner_email = None
 
-    # генерируем короткий id и убеждаемся, что он уникален в БД
-    id_ = None
-    for _ in range(5):
-        candidate = uuid.uuid4().hex[:8]
-        if db.session.get(DynamicLink, candidate) is None:
-            id_ = candidate
-            break
+    # генерируем кандидатов заранее и проверяем занятость одним SELECT
+    # вместо до пяти round-trip'ов в БД; url-safe base64 от 6 байт даёт
+    # те же 8 символов, но 48 бит энтропии против 32 у hex-среза
+    cands = [_new_dynamic_id() for _ in range(5)]
+    taken = set(db.session.scalars(
+        db.select(DynamicLink.id).where(DynamicLink.id.in_(cands))
+    ).all())
+    id_ = next((c for c in cands if c not in taken), None)
     if not id_:
         # можно кинуть исключение, чтобы поймать выше
         raise RuntimeError("Could not generate unique id")
@@ -178,25 +232,62 @@ def current_user():
     return session.get("user")
 
 
+def _session_email() -> str:
+    return ((current_user() or {}).get("email") or "").lower()
+
+
+def _user_status():
+    """
+    Строка UserStatus текущего пользователя, один SELECT на запрос.
+    Результат (включая None для анонима) кэшируется в g.
+    """
+    if "user_status" in g:
+        return g.user_status
+
+    email = _session_email()
+    g.user_status = (
+        db.session.execute(
+            db.select(UserStatus).filter_by(email=email)
+        ).scalar_one_or_none()
+        if email
+        else None
+    )
+    return g.user_status
+
+
 def get_or_create_user(email: str):
     """
     Находит пользователя по email в DB или создает нового.
     """
     email_lower = email.lower()
-    user_status = db.session.execute(
-        db.select(UserStatus).filter_by(email=email_lower)
-    ).scalar_one_or_none()
+    if email_lower == _session_email():
+        user_status = _user_status()
+    else:
+        user_status = db.session.execute(
+            db.select(UserStatus).filter_by(email=email_lower)
+        ).scalar_one_or_none()
 
     if user_status is None:
         user_status = UserStatus(email=email_lower, has_one_time_access=False)
         db.session.add(user_status)
         db.session.commit()
+        if email_lower == _session_email():
+            g.user_status = user_status
     return user_status
 
 
 def is_pro() -> bool:
-    u = current_user()
-    email = (u or {}).get("email", "").lower()
+    # tpl_args/is_paid дёргают is_pro() несколько раз за запрос —
+    # кэшируем результат в g, чтобы не ходить в БД повторно
+    if "is_pro" in g:
+        return g.is_pro
+
+    g.is_pro = _compute_is_pro()
+    return g.is_pro
+
+
+def _compute_is_pro() -> bool:
+    email = _session_email()
 
     # 1) Admin / ручной Pro
     if email and email in PREMIUM_EMAILS:
@@ -204,9 +295,7 @@ def is_pro() -> bool:
 
     # 2) Pro через подписку или one-time в базе
     if email:
-        user_status = db.session.execute(
-            db.select(UserStatus).filter_by(email=email)
-        ).scalar_one_or_none()
+        user_status = _user_status()
         if user_status:
             if user_status.is_sub_pro and user_status.subscription_status == "active":
                 return True
@@ -228,6 +317,7 @@ def is_paid() -> bool:
     return bool(is_pro() or is_one_time())
 
 
+@functools.lru_cache(maxsize=1024)
 def normalize_url(link: str) -> str:
     v = (link or "").strip()
     if not v:
@@ -238,6 +328,7 @@ def normalize_url(link: str) -> str:
     return "https://" + v
 
 
+@functools.lru_cache(maxsize=1024)
 def _normalize_hex(h: str) -> str:
     h = (h or "").strip()
     if not h:
@@ -249,6 +340,22 @@ def _normalize_hex(h: str) -> str:
     return h.lower()
 
 
+_HEX_COLOR_RE = re.compile(r"\A#[0-9a-f]{6}\Z")
+
+
+def _safe_hex(value) -> str | None:
+    """
+    Канонический #rrggbb или None для мусора. Длину проверяем ДО
+    мемоизированных вызовов: ключами кэшей (_normalize_hex, _hex_to_rgb,
+    _check_contrast, рендер) должны быть только короткие валидные строки.
+    """
+    if not isinstance(value, str) or len(value) > 7:
+        return None
+    h = _normalize_hex(value)
+    return h if _HEX_COLOR_RE.match(h) else None
+
+
+@functools.lru_cache(maxsize=1024)
 def _hex_to_rgb(h: str):
     h = (h or "#000000").lstrip("#")
     if len(h) == 3:
@@ -259,6 +366,7 @@ def _hex_to_rgb(h: str):
         return (0, 0, 0)
 
 
+@functools.lru_cache(maxsize=256)
 def _mix(c_back, c_fill, ratio: float = 0.18):
     rb, gb, bb = c_back
     rf, gf, bf = c_fill
@@ -268,24 +376,28 @@ def _mix(c_back, c_fill, ratio: float = 0.18):
     return (r, g, b)
 
 
-def _srgb_gamma(c_norm: float) -> float:
-    """Гамма-коррекция для нормализованного RGB (0-1)."""
-    if c_norm <= 0.03928:
-        return c_norm / 12.92
-    else:
-        return ((c_norm + 0.055) / 1.055) ** 2.4
+# sRGB → linear одной таблицей на 256 значений: убирает pow() и ветку
+# гамма-коррекции на каждый канал при проверке контраста
+_srgb_c = np.arange(256, dtype=np.float64) / 255.0
+_SRGB_LUT = np.where(
+    _srgb_c <= 0.03928, _srgb_c / 12.92, ((_srgb_c + 0.055) / 1.055) ** 2.4
+).astype(np.float32)
+del _srgb_c
 
 
 def _get_luminance(rgb: tuple[int, int, int]) -> float:
-    """Расчет относительной яркости (L) по WCAG."""
-    r_s = _srgb_gamma(rgb[0] / 255.0)
-    g_s = _srgb_gamma(rgb[1] / 255.0)
-    b_s = _srgb_gamma(rgb[2] / 255.0)
-    return 0.2126 * r_s + 0.7152 * g_s + 0.0722 * b_s
+    """Расчет относительной яркости (L) по WCAG через предвычисленный LUT."""
+    return float(
+        0.2126 * _SRGB_LUT[rgb[0]]
+        + 0.7152 * _SRGB_LUT[rgb[1]]
+        + 0.0722 * _SRGB_LUT[rgb[2]]
+    )
 
 
+@functools.lru_cache(maxsize=512)
 def _check_contrast(c1_hex: str, c2_hex: str, min_ratio: float = 4.5) -> bool:
-    """Проверка коэффициента контрастности (CR)."""
+    """Проверка коэффициента контрастности (CR). Палитр мало — кэшируем
+    пару целиком, это точнее и дешевле любых эвристических отсечек."""
     rgb1 = _hex_to_rgb(c1_hex)
     rgb2 = _hex_to_rgb(c2_hex)
 
@@ -300,26 +412,37 @@ def _check_contrast(c1_hex: str, c2_hex: str, min_ratio: float = 4.5) -> bool:
 
 
 def _tint_icon_png_to_color(png_rgba: Image.Image, rgb) -> Image.Image:
-    icon = png_rgba.convert("RGBA")
-    r, g, b, a = icon.split()
-    colored = Image.new("RGBA", icon.size, (*rgb, 255))
-    colored.putalpha(a)
-    return colored
-
-
-def _draw_badge(base_img: Image.Image, box, radius: int, fill_hex: str, back_hex: str):
-    x0, y0, x1, y1 = box
-    w = x1 - x0
-    h = y1 - y0
+    # заливаем цвет одной векторной записью вместо split/new/putalpha
+    # (те делали три полных прохода по картинке)
+    a = np.asarray(png_rgba.convert("RGBA"))[..., 3]
+    out = np.empty(a.shape + (4,), dtype=np.uint8)
+    out[..., 0] = rgb[0]
+    out[..., 1] = rgb[1]
+    out[..., 2] = rgb[2]
+    out[..., 3] = a
+    return Image.fromarray(out, "RGBA")
+
+
+@functools.lru_cache(maxsize=64)
+def _badge_sprite(w: int, h: int, radius: int, fill_hex: str, back_hex: str):
+    """
+    Готовый бейдж — тень, плашка и внутренняя обводка, слитые в один
+    RGBA-спрайт. Размеры/палитры в проде повторяются, поэтому кэшируем:
+    блюр тени и три rounded_rectangle выполняются только на промахе.
+    Возвращает (спрайт, shadow_pad) — спрайт шире бокса на отступ тени.
+    """
     plate_rgb = _mix(_hex_to_rgb(back_hex), _hex_to_rgb(fill_hex), 0.18)
     outline_rgba = (*_hex_to_rgb(fill_hex), 110)
 
     shadow_pad = 6
-    shadow = Image.new("RGBA", (w + shadow_pad * 2, h + shadow_pad * 2), (0, 0, 0, 0))
-    sdraw = ImageDraw.Draw(shadow)
+    sprite = Image.new("RGBA", (w + shadow_pad * 2, h + shadow_pad * 2), (0, 0, 0, 0))
+    sdraw = ImageDraw.Draw(sprite)
     sdraw.rounded_rectangle((shadow_pad, shadow_pad, shadow_pad + w, shadow_pad + h),
                             radius=radius, fill=(0, 0, 0, 80))
-    shadow = shadow.filter(ImageFilter.GaussianBlur(6))
+    # три box-блюра ≈ гауссиана, но на целочисленных суммах — в 2-3 раза
+    # дешевле, а для мягкой тени разница не видна
+    for _ in range(3):
+        sprite = sprite.filter(ImageFilter.BoxBlur(3))
 
     plate = Image.new("RGBA", (w, h), (0, 0, 0, 0))
     pdraw = ImageDraw.Draw(plate)
@@ -332,16 +455,39 @@ def _draw_badge(base_img: Image.Image, box, radius: int, fill_hex: str, back_hex
     idraw.rounded_rectangle((inset, inset, w - inset, h - inset), radius=max(1, radius - inset),
                             outline=(255, 255, 255, 90), width=1)
 
-    base = base_img.copy()
-    base.alpha_composite(shadow, (x0 - shadow_pad, y0 - shadow_pad))
-    base.alpha_composite(plate, (x0, y0))
-    base.alpha_composite(inner, (x0, y0))
-    return base
+    sprite.alpha_composite(plate, (shadow_pad, shadow_pad))
+    sprite.alpha_composite(inner, (shadow_pad, shadow_pad))
+    return sprite, shadow_pad
+
+
+def _draw_badge(base_img: Image.Image, box, radius: int, fill_hex: str, back_hex: str):
+    # рисуем прямо в буфер вызывающего: оба overlay-хелпера владеют своим
+    # img (свежий кадр рендера), копия на весь размер QR здесь не нужна
+    x0, y0, x1, y1 = box
+    sprite, pad = _badge_sprite(x1 - x0, y1 - y0, radius, fill_hex, back_hex)
+    base_img.alpha_composite(sprite, (x0 - pad, y0 - pad))
+    return base_img
 
 
 SAFE_ICON_SCALE = 0.18  # было 0.24 – уменьшили, чтобы логотип не лез к краям
 
 
+@functools.lru_cache(maxsize=256)
+def _tinted_icon(path: str, rgb: tuple, target: int) -> Image.Image | None:
+    """
+    Тонированная и уменьшенная иконка. Кэш по (файл, цвет, размер), чтобы
+    Image.open + convert + tint + LANCZOS-thumbnail не повторялись на каждый
+    запрос. Результат только читается (alpha_composite), поэтому без copy().
+    """
+    try:
+        icon = Image.open(path).convert("RGBA")
+    except Exception:
+        return None
+    icon = _tint_icon_png_to_color(icon, rgb)
+    icon.thumbnail((target, target), Image.LANCZOS)
+    return icon
+
+
 def _overlay_wifi_png(img: Image.Image, fill_hex: str, back_hex: str) -> Image.Image:
     img = img.convert("RGBA")
     W, H = img.size
@@ -355,12 +501,11 @@ def _overlay_wifi_png(img: Image.Image, fill_hex: str, back_hex: str) -> Image.I
 
     path = os.path.join(app.static_folder, "icons", "wifi.png")
     if os.path.exists(path):
-        base_png = Image.open(path).convert("RGBA")
-        colored_png = _tint_icon_png_to_color(base_png, _hex_to_rgb(fill_hex))
-        target = side  # без 1.1 – логотип строго в бейдже
-        colored_png.thumbnail((target, target), Image.LANCZOS)
-        iw, ih = colored_png.size
-        img.alpha_composite(colored_png, (cx - iw // 2, cy - ih // 2))
+        # target = side, без 1.1 – логотип строго в бейдже
+        colored_png = _tinted_icon(path, _hex_to_rgb(fill_hex), side)
+        if colored_png is not None:
+            iw, ih = colored_png.size
+            img.alpha_composite(colored_png, (cx - iw // 2, cy - ih // 2))
     return img
 
 
@@ -377,25 +522,24 @@ def _overlay_user_png(img: Image.Image, fill_hex: str, back_hex: str, custom_ico
 
     icon_img = None
     if custom_icon_path and os.path.exists(custom_icon_path):
-        try:
-            icon_img = Image.open(custom_icon_path).convert("RGBA")
-        except Exception:
-            icon_img = None
+        icon_img = _tinted_icon(custom_icon_path, _hex_to_rgb(fill_hex), side)
     if icon_img is None:
         fallback = os.path.join(app.static_folder, "icons", "user.png")
         if os.path.exists(fallback):
-            icon_img = Image.open(fallback).convert("RGBA")
+            icon_img = _tinted_icon(fallback, _hex_to_rgb(fill_hex), side)
 
     if icon_img is not None:
-        icon_img = _tint_icon_png_to_color(icon_img, _hex_to_rgb(fill_hex))
-        target = side  # без 1.1
-        icon_img.thumbnail((target, target), Image.LANCZOS)
         iw, ih = icon_img.size
         img.alpha_composite(icon_img, (cx - iw // 2, cy - ih // 2))
     return img
 
 
-def _load_ttf(px: int) -> ImageFont.FreeTypeFont | None:
+@functools.cache
+def _resolve_ttf_path() -> str | None:
+    """
+    Путь к TTF резолвится один раз на процесс: шрифты не меняются,
+    а прохождение списка кандидатов — это куча os.path.exists-сисколлов.
+    """
     candidates: list[str] = []
 
     here = os.path.dirname(os.path.abspath(__file__))
@@ -424,9 +568,20 @@ def _load_ttf(px: int) -> ImageFont.FreeTypeFont | None:
     for p in candidates:
         try:
             if os.path.exists(p):
-                return ImageFont.truetype(p, px)
+                return p
         except Exception:
             continue
+    return None
+
+
+@functools.lru_cache(maxsize=32)
+def _load_ttf(px: int) -> ImageFont.FreeTypeFont | None:
+    path = _resolve_ttf_path()
+    if path:
+        try:
+            return ImageFont.truetype(path, px)
+        except Exception:
+            pass
 
     try:
         return ImageFont.truetype("DejaVuSans.ttf", px)
@@ -434,6 +589,80 @@ def _load_ttf(px: int) -> ImageFont.FreeTypeFont | None:
         return None
 
 
+@functools.lru_cache(maxsize=256)
+def _watermark_block(text: str, fpx: int, rot: int,
+                     text_col: tuple, stroke_col: tuple, stroke_w: int,
+                     fallback: bool) -> Image.Image:
+    """
+    Отрисованный (и при rot — повёрнутый) блок текста ватермарки.
+    Кэшируется: freetype-растеризация глифов не повторяется на каждый QR.
+    Возвращаемую картинку никто не мутирует — alpha_composite только читает.
+    """
+    font = ImageFont.load_default() if fallback else _load_ttf(fpx)
+
+    # считаем ширину текста
+    dtmp = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+    tw = int(dtmp.textlength(text, font=font))
+    th = int((getattr(font, "size", 12)) * 1.2)
+
+    blk = Image.new("RGBA", (tw, th), (0, 0, 0, 0))
+    d2 = ImageDraw.Draw(blk)
+    d2.text(
+        (tw // 2, th // 2),
+        text,
+        font=font,
+        anchor="mm",
+        fill=text_col,
+        stroke_width=stroke_w,
+        stroke_fill=stroke_col,
+    )
+
+    # НИКАКОГО ресайза bitmap-шрифта — при fallback он превращает текст в кашу
+    if rot:
+        blk = blk.rotate(rot, expand=True)
+    return blk
+
+
+@functools.lru_cache(maxsize=64)
+def _watermark_strip_h(total_w: int, strip_h: int, gap: int, text: str, fpx: int,
+                       text_col: tuple, stroke_col: tuple, stroke_w: int,
+                       fallback: bool) -> Image.Image:
+    """
+    Полная горизонтальная полоса ватермарки. Размеры выдачи фиксированные,
+    так что полоса тайлится один раз и дальше переиспользуется целиком.
+    """
+    block = _watermark_block(text, fpx, 0, text_col, stroke_col, stroke_w, fallback)
+    strip = Image.new("RGBA", (total_w, strip_h), (0, 0, 0, 0))
+    y = strip_h // 2 - block.height // 2
+    # тайлим удвоением: кладём один период, дальше копируем уже заполненную
+    # часть целиком — log2(N) paste'ов вместо N композитов по блоку
+    period = block.width + gap
+    strip.paste(block, (gap, y))
+    filled = period
+    while filled < total_w:
+        chunk = strip.crop((0, 0, min(filled, total_w - filled), strip_h))
+        strip.paste(chunk, (filled, 0))
+        filled *= 2
+    return strip
+
+
+@functools.lru_cache(maxsize=64)
+def _watermark_strip_v(total_h: int, strip_w: int, gap: int, text: str, fpx: int,
+                       text_col: tuple, stroke_col: tuple, stroke_w: int,
+                       fallback: bool) -> Image.Image:
+    block = _watermark_block(text, fpx, 90, text_col, stroke_col, stroke_w, fallback)
+    strip = Image.new("RGBA", (strip_w, total_h), (0, 0, 0, 0))
+    x = strip_w // 2 - block.width // 2
+    period = block.height + gap
+    strip.paste(block, (x, gap))
+    filled = period
+    while filled < total_h:
+        chunk = strip.crop((0, 0, strip_w, min(filled, total_h - filled)))
+        strip.paste(chunk, (0, filled))
+        filled *= 2
+    return strip
+
+
 def _add_watermark_border(
         img: Image.Image,
         text: str = "Created by ColorQR.app",
@@ -443,7 +672,6 @@ def _add_watermark_border(
         margin_scale: float = 0.05,
         gap_scale: float = 0.05
 ) -> Image.Image:
-    img = img.convert("RGBA")
     W, H = img.size
     side = min(W, H)
 
@@ -452,18 +680,19 @@ def _add_watermark_border(
 
     # фон берём из back_hex, чтобы на цветных фонах всё было консистентно
     back_rgb = _hex_to_rgb(back_hex)
-    frame = Image.new("RGBA", (W + 2 * m, H + 2 * m), (*back_rgb, 255))
-    frame.alpha_composite(img, (m, m))
+    # собираем сразу финальный RGB-кадр (JPEG всё равно без альфы):
+    # numpy-broadcast вместо попиксельного филла, и никакого сведения потом
+    arr = np.empty((H + 2 * m, W + 2 * m, 3), dtype=np.uint8)
+    arr[...] = back_rgb
+    frame = Image.fromarray(arr, "RGB")
+    # QR-кадр непрозрачный (альфа, если есть, везде 255) — простой paste
+    frame.paste(img, (m, m))
 
     # размер шрифта для нормального TTF
     fpx = max(int(side * float(font_scale)), 22)
 
-    font = _load_ttf(fpx)
-    fallback = False
-    if font is None:
-        # если нормального TTF нет — используем встроенный bitmap-шрифт
-        fallback = True
-        font = ImageFont.load_default()
+    # если нормального TTF нет — встроенный bitmap-шрифт
+    fallback = _load_ttf(fpx) is None
 
     def lum(rgb):
         r, g, b = [c / 255.0 for c in rgb]
@@ -475,106 +704,119 @@ def _add_watermark_border(
     # важный момент: при fallback обводку делаем тонкой, чтобы не замыливать мелкий шрифт
     stroke_w = max(1, (fpx // 14) if not fallback else 1)
 
-    def make_block(rot=0):
-        # считаем ширину текста
-        dtmp = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
-        tw = int(dtmp.textlength(text, font=font))
-        th = int((getattr(font, "size", 12)) * 1.2)
-
-        blk = Image.new("RGBA", (tw, th), (0, 0, 0, 0))
-        d2 = ImageDraw.Draw(blk)
-        d2.text(
-            (tw // 2, th // 2),
-            text,
-            font=font,
-            anchor="mm",
-            fill=text_col,
-            stroke_width=stroke_w,
-            stroke_fill=stroke_col,
-        )
-
-        # 🔴 ГЛАВНОЕ ИЗМЕНЕНИЕ:
-        # больше НИКАКОГО ресайза bitmap-шрифта. Раньше тут был blk.resize(..., LANCZOS),
-        # который и превращал текст в кашу при fallback.
-        if rot:
-            blk = blk.rotate(rot, expand=True)
-        return blk
-
-    block_h = make_block(0)
-    block_v = make_block(90)
+    block_h = _watermark_block(text, fpx, 0, text_col, stroke_col, stroke_w, fallback)
+    block_v = _watermark_block(text, fpx, 90, text_col, stroke_col, stroke_w, fallback)
 
     gap_h = max(int((W + 2 * m) * float(gap_scale)), int(block_h.width * 0.4))
     gap_v = max(int((H + 2 * m) * float(gap_scale)), int(block_v.height * 0.4))
 
     strip_h_h = max(int(fpx * 1.35), block_h.height + 2)
-
-    def tile_h(y_top):
-        strip = Image.new("RGBA", (W + 2 * m, strip_h_h), (0, 0, 0, 0))
-        x = -block_h.width
-        y = strip_h_h // 2 - block_h.height // 2
-        while x < (W + 2 * m) - block_h.width + gap_h:
-            strip.alpha_composite(block_h, (x, y))
-            x += block_h.width + gap_h
-        frame.alpha_composite(strip, (0, y_top))
-
     strip_v_w = max(int(fpx * 1.10), block_v.width + 2)
 
-    def tile_v(x_left):
-        strip = Image.new("RGBA", (strip_v_w, H + 2 * m), (0, 0, 0, 0))
-        y = -block_v.height
-        x = strip_v_w // 2 - block_v.width // 2
-        while y < (H + 2 * m) - block_v.height + gap_v:
-            strip.alpha_composite(block_v, (x, y))
-            y += block_v.height + gap_v
-        frame.alpha_composite(strip, (x_left, 0))
+    strip_h = _watermark_strip_h(W + 2 * m, strip_h_h, gap_h,
+                                 text, fpx, text_col, stroke_col, stroke_w, fallback)
+    strip_v = _watermark_strip_v(H + 2 * m, strip_v_w, gap_v,
+                                 text, fpx, text_col, stroke_col, stroke_w, fallback)
 
+    # полосы кладём paste'ом с их же альфой как маской — blend прямо в RGB
     # верх/низ
-    tile_h(0)
-    tile_h(H + m)
+    frame.paste(strip_h, (0, 0), strip_h)
+    frame.paste(strip_h, (0, H + m), strip_h)
     # левый/правый
-    tile_v(0)
-    tile_v(W + m)
+    frame.paste(strip_v, (0, 0), strip_v)
+    frame.paste(strip_v, (W + m, 0), strip_v)
 
     return frame
 
 
 
+# горячие jpg/svg держим в памяти процесса: скачивание сразу после
+# генерации (основной сценарий) не ходит на диск вообще
+_FILE_CACHE_MAX = 256
+_file_cache: "OrderedDict[str, bytes]" = OrderedDict()
+_file_cache_lock = threading.Lock()
+
+
+def _cache_put(key: str, data: bytes) -> None:
+    with _file_cache_lock:
+        _file_cache[key] = data
+        _file_cache.move_to_end(key)
+        while len(_file_cache) > _FILE_CACHE_MAX:
+            _file_cache.popitem(last=False)
+
+
+def _cache_get(key: str) -> bytes | None:
+    with _file_cache_lock:
+        data = _file_cache.get(key)
+        if data is not None:
+            _file_cache.move_to_end(key)
+        return data
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    """
+    Пишем во временный файл и публикуем через os.replace: параллельный
+    читатель никогда не увидит полузаписанный файл. fsync не делаем —
+    файлы и так живут не дольше QR_MAX_AGE_HOURS.
+    """
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _link_or_write(src: str, dst: str, data: bytes) -> None:
+    """
+    Вторая копия тех же байтов под другим именем: жёсткая ссылка вместо
+    повторной записи — хранится один инод. Если линк невозможен (dst уже
+    есть, другая ФС), падаем обратно на атомарную запись.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        _write_atomic(dst, data)
+
+
 def _save_jpg_from_rgba(pil_rgba: Image.Image, quality: int = 90) -> bytes:
-    bg = Image.new("RGB", pil_rgba.size, (255, 255, 255))
-    bg.paste(pil_rgba, mask=pil_rgba.split()[-1])
+    if pil_rgba.mode == "RGB":
+        # кадр пришёл без альфы вовсе (чистый QR без оверлеев)
+        bg = pil_rgba
+    elif pil_rgba.getextrema()[-1][0] == 255:
+        # альфа везде 255 (обычный кадр QR) — сведение не нужно вовсе
+        bg = pil_rgba.convert("RGB")
+    else:
+        # сведение альфы на белый фон одним векторным выражением вместо
+        # Image.new + paste(mask=...) — те сканировали картинку дважды
+        arr = np.asarray(pil_rgba, dtype=np.uint16)
+        a = arr[..., 3:4]
+        rgb = ((arr[..., :3] * a + 255 * (255 - a)) // 255).astype(np.uint8)
+        bg = Image.fromarray(rgb, "RGB")
     buf = BytesIO()
-    bg.save(buf, format="JPEG", quality=quality, optimize=True)
+    # optimize=True гонит второй полный проход ради оптимальных таблиц Хаффмана —
+    # на плоских QR-картинках экономия пары КБ не стоит этого CPU
+    bg.save(buf, format="JPEG", quality=quality)
     return buf.getvalue()
 
 
+@functools.lru_cache(maxsize=256)
 def _gen_svg_bytes(data: str, fill_color: str, back_color: str) -> bytes:
     """
-    Генерация SVG с нужной палитрой.
-    Если библиотека qrcode игнорирует цвета, мы перекрашиваем SVG постфактум.
+    Генерация SVG через segno: один <path> на все модули, цвета задаются
+    сразу — никакой перекраски строки постфактум не нужно.
+    Выход детерминирован по входам, поэтому кэшируем (bytes иммутабельны).
     """
     fill_color = _normalize_hex(fill_color)
     back_color = _normalize_hex(back_color)
 
-    qr = qrcode.QRCode(
-        version=None,
-        error_correction=qrcode.constants.ERROR_CORRECT_H,
-        box_size=10,
-        border=4,
-        image_factory=SvgPathImage
-    )
-    qr.add_data(data)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color=fill_color, back_color=back_color)
+    qr = segno.make(data, error="h")
     out = BytesIO()
-    img.save(out)
-
-    svg_text = out.getvalue().decode("utf-8", errors="ignore")
+    qr.save(out, kind="svg", scale=10, border=4,
+            dark=fill_color, light=back_color)
+    return out.getvalue()
 
-    # На случай, если библиотека всё равно оставила дефолтные цвета
-    svg_text = svg_text.replace('fill="#000000"', f'fill="{fill_color}"')
-    svg_text = svg_text.replace('fill="#ffffff"', f'fill="{back_color}"')
 
-    return svg_text.encode("utf-8")
+# вытаскиваем хост без полного urlparse — нам нужен только домен
+_HOST_RE = re.compile(r"\Ahttps?://(?:www\.)?([^/:?#]+)", re.I)
 
 
 def _build_download_name(data_type: str, raw_data: str) -> str:
@@ -586,14 +828,9 @@ def _build_download_name(data_type: str, raw_data: str) -> str:
     base = "colorqr"
 
     if data_type in ("url", "dynamic"):
-        try:
-            parsed = urlparse(raw_data)
-            host = parsed.netloc or ""
-            host = host.replace("www.", "")
-            if host:
-                base = host.split(":")[0]
-        except Exception:
-            pass
+        m = _HOST_RE.match(raw_data or "")
+        if m:
+            base = m.group(1)
     elif data_type == "wifi":
         base = "wifi-qr"
     elif data_type == "vcard":
@@ -605,6 +842,49 @@ def _build_download_name(data_type: str, raw_data: str) -> str:
     return f"{base}-{ts}"
 
 
+QR_MAX_AGE_HOURS = float(os.environ.get("QR_MAX_AGE_HOURS", "24"))
+
+
+def clean_old_files(max_age_hours: float = QR_MAX_AGE_HOURS) -> None:
+    """
+    Удаляет устаревшие превью ({uid}.jpg/.svg) из DATA_DIR.
+    Файлы динамических QR лежат в DYNAMIC_QR_DIR и не трогаются — они постоянные.
+    os.scandir вместо listdir + isfile + getmtime: один syscall на запись вместо трёх.
+    """
+    cutoff = time.time() - max_age_hours * 3600.0
+    try:
+        with os.scandir(DATA_DIR) as it:
+            for entry in it:
+                if not entry.name.endswith((".jpg", ".svg", ".tmp")):
+                    continue
+                try:
+                    if entry.is_file(follow_symlinks=False) \
+                            and entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                        os.remove(entry.path)
+                except OSError:
+                    continue
+    except FileNotFoundError:
+        pass
+
+
+QR_CLEAN_INTERVAL_SEC = int(os.environ.get("QR_CLEAN_INTERVAL_SEC", "600"))
+
+
+def _cleanup_loop():
+    while True:
+        try:
+            clean_old_files()
+        except Exception as e:
+            app.logger.error(f"clean_old_files failed: {e}")
+        time.sleep(QR_CLEAN_INTERVAL_SEC)
+
+
+# фоновая чистка вместо вызова на каждом запросе;
+# под werkzeug-reloader дочерний процесс поток не поднимает
+if os.environ.get("WERKZEUG_RUN_MAIN") != "true":
+    threading.Thread(target=_cleanup_loop, daemon=True).start()
+
+
 # ---------------------- CONTENT (FAQ/Blog) ----------------------
 POSTS = [
     {
@@ -623,6 +903,10 @@ POSTS = [
     },
 ]
 
+# сортировка и индекс по slug — статичные, считаем один раз при импорте
+POSTS_SORTED = sorted(POSTS, key=lambda p: p["date"], reverse=True)
+POSTS_BY_SLUG = {p["slug"]: p for p in POSTS}
+
 FAQS = [
     {"q": "Is ColorQR free?", "a": "Yes, the core features (URL, Wi-Fi, Text) are free."},
     {"q": "Do you store passwords or logins?", "a": "No. We only use Google Sign-In. No passwords are stored at all."},
@@ -641,17 +925,20 @@ FAQS = [
 
 # ---------------------- ROUTES: PAGES ----------------------
 def tpl_args(active):
-    post_login_msg = session.pop("post_login_redirect", False)
+    # считаем статусы один раз — is_pro/is_paid дальше просто переиспользуем
+    pro = is_pro()
+    one_time = is_one_time()
+    paid = pro or one_time
     return dict(
         active=active,
         user=current_user(),
-        is_pro=is_pro(),
-        is_one_time=is_one_time(),
-        is_paid=is_paid(),
-        show_vcard=is_pro(),
-        show_dynamic=is_pro(),
-        extra_palettes=is_paid(),
-        post_login_msg=post_login_msg,
+        is_pro=pro,
+        is_one_time=one_time,
+        is_paid=paid,
+        show_vcard=pro,
+        show_dynamic=pro,
+        extra_palettes=paid,
+        post_login_msg=session.pop("post_login_redirect", False),
     )
 
 
@@ -668,13 +955,10 @@ def about():
 
 @app.route("/pricing")
 def pricing():
-    stripe_pub_key = os.environ.get("STRIPE_PUBLISHABLE_KEY")
-    price_cents = os.environ.get("ONE_TIME_PRICE_CENTS", "199")
-
     return render_template(
         "pricing.html",
-        stripe_pub_key=stripe_pub_key,
-        one_time_price=int(price_cents) / 100,
+        stripe_pub_key=STRIPE_PUB_KEY,
+        one_time_price=ONE_TIME_PRICE_CENTS / 100,
         **tpl_args("pricing")
     )
 
@@ -691,26 +975,28 @@ def faq():
 
 @app.route("/blog")
 def blog():
-    posts = sorted(POSTS, key=lambda p: p["date"], reverse=True)
-    return render_template("blog.html", **tpl_args("blog"), posts=posts)
+    return render_template("blog.html", **tpl_args("blog"), posts=POSTS_SORTED)
 
 
 @app.route("/blog/<slug>")
 def blog_post(slug):
-    post = next((p for p in POSTS if p["slug"] == slug), None)
+    post = POSTS_BY_SLUG.get(slug)
     if not post:
         return redirect(url_for("blog"))
     return render_template("post.html", **tpl_args("blog"), post=post)
 
 
+# самый частый бот-трафик: отдаём с недельным кэшем и 304 на повторе
 @app.route("/robots.txt")
 def robots():
-    return send_from_directory(app.static_folder, "robots.txt")
+    return send_from_directory(app.static_folder, "robots.txt",
+                               max_age=604800, conditional=True)
 
 
 @app.route("/sitemap.xml")
 def sitemap():
-    return send_from_directory(app.static_folder, "sitemap.xml")
+    return send_from_directory(app.static_folder, "sitemap.xml",
+                               max_age=604800, conditional=True)
 
 
 # ---------------------- AUTH ----------------------
@@ -752,7 +1038,7 @@ def auth_callback():
 # Stripe checkout
 @app.route("/create-checkout-session", methods=["POST"])
 def create_checkout_session():
-    price_cents = int(os.environ.get("ONE_TIME_PRICE_CENTS", 199))
+    price_cents = ONE_TIME_PRICE_CENTS
 
     session_data = {
         "payment_method_types": ["card"],
@@ -794,7 +1080,7 @@ def create_subscription_session():
         # можно редиректить на логин, но здесь вернём 401 и на фронте открыть /login
         return jsonify({"error": "Auth required"}), 401
 
-    price_id = os.environ.get("STRIPE_PRO_MONTHLY_PRICE_ID")
+    price_id = PRO_PRICE_ID
     if not price_id:
         return jsonify({"error": "Missing STRIPE_PRO_MONTHLY_PRICE_ID"}), 500
 
@@ -876,7 +1162,7 @@ def payment_success():
 def stripe_webhook():
     payload = request.data
     sig_header = request.headers.get("Stripe-Signature")
-    webhook_secret = os.environ.get("STRIPE_WEBHOOK_SECRET")
+    webhook_secret = STRIPE_WEBHOOK_SECRET
 
     if not webhook_secret:
         app.logger.error("STRIPE_WEBHOOK_SECRET not set")
@@ -897,39 +1183,54 @@ def stripe_webhook():
         app.logger.error(f"Webhook signature error: {e}")
         return "", 400
 
+    # идемпотентность: Stripe ретраит доставку, дубль отсекаем одним
+    # PK-инсертом. Коммитим его ВМЕСТЕ с обновлениями ниже: если обработка
+    # упадёт, откатится и dedup-запись, и ретрай Stripe обработает событие
+    inserted = db.session.execute(
+        sqlite_insert(WebhookEvent).values(id=event["id"]).on_conflict_do_nothing()
+    ).rowcount
+    if not inserted:
+        db.session.rollback()
+        return "", 200
+
     # Обрабатываем интересующие события
     event_type = event["type"]
     data = event["data"]["object"]
 
-    # 1) Подписка создана / обновлена
-    if event_type in ("customer.subscription.created", "customer.subscription.updated"):
-        sub = data
-        customer_id = sub["customer"]
-        status = sub["status"]  # trialing, active, past_due, canceled, etc.
-
-        user = db.session.execute(
-            db.select(UserStatus).filter_by(stripe_customer_id=customer_id)
-        ).scalar_one_or_none()
-
-        if user:
-            user.subscription_status = status
-            user.is_sub_pro = status in ("trialing", "active")
-            user.stripe_subscription_id = sub["id"]
-            db.session.commit()
-
-    # 2) Подписка отменена
-    if event_type == "customer.subscription.deleted":
-        sub = data
-        customer_id = sub["customer"]
-
-        user = db.session.execute(
-            db.select(UserStatus).filter_by(stripe_customer_id=customer_id)
-        ).scalar_one_or_none()
+    try:
+        # 1) Подписка создана / обновлена
+        if event_type in ("customer.subscription.created", "customer.subscription.updated"):
+            sub = data
+            customer_id = sub["customer"]
+            status = sub["status"]  # trialing, active, past_due, canceled, etc.
+
+            user = db.session.execute(
+                db.select(UserStatus).filter_by(stripe_customer_id=customer_id)
+            ).scalar_one_or_none()
+
+            if user:
+                user.subscription_status = status
+                user.is_sub_pro = status in ("trialing", "active")
+                user.stripe_subscription_id = sub["id"]
+
+        # 2) Подписка отменена
+        if event_type == "customer.subscription.deleted":
+            sub = data
+            customer_id = sub["customer"]
+
+            user = db.session.execute(
+                db.select(UserStatus).filter_by(stripe_customer_id=customer_id)
+            ).scalar_one_or_none()
+
+            if user:
+                user.subscription_status = "canceled"
+                user.is_sub_pro = False
 
-        if user:
-            user.subscription_status = "canceled"
-            user.is_sub_pro = False
-            db.session.commit()
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Webhook processing failed for {event['id']}: {e}")
+        return "", 500
 
     return "", 200
 
@@ -1004,8 +1305,12 @@ if DEBUG_MODE:
 @app.route("/api/check_contrast", methods=["POST"])
 def check_contrast_api():
     payload = request.get_json(force=True, silent=True) or {}
-    fill_color = payload.get("fill_color", "#000000")
-    back_color = payload.get("back_color", "#ffffff")
+    # канонизация до мемоизированной проверки: мусор не оседает в кэшах,
+    # а #FFF/#fff/#ffffff занимают один слот, а не три
+    fill_color = _safe_hex(payload.get("fill_color", "#000000"))
+    back_color = _safe_hex(payload.get("back_color", "#ffffff"))
+    if fill_color is None or back_color is None:
+        return jsonify({"error": "Invalid color format (expected #rrggbb)"}), 400
 
     is_safe = _check_contrast(fill_color, back_color, min_ratio=4.5)
     return jsonify({"safe": is_safe})
@@ -1017,6 +1322,11 @@ def upload_icon():
     if not is_pro():
         return jsonify({"error": "Pro required"}), 403
 
+    # отсечка по Content-Length до разбора multipart — слишком большой
+    # аплоад отклоняем, не буферизуя тело
+    if request.content_length and request.content_length > MAX_ICON_SIZE_BYTES + 8192:
+        return jsonify({"error": "File too large (max 512KB)"}), 413
+
     if "file" not in request.files:
         return jsonify({"error": "No file"}), 400
 
@@ -1028,11 +1338,13 @@ def upload_icon():
     if ext not in ALLOWED_ICON_EXT:
         return jsonify({"error": "Only PNG is supported"}), 400
 
+    # авторитетная проверка уже принятого файла: fast-path по Content-Length
+    # выше не ловит chunked-загрузки, где заголовка нет
     f.seek(0, os.SEEK_END)
     size = f.tell()
     f.seek(0)
     if size > MAX_ICON_SIZE_BYTES:
-        return jsonify({"error": "File too large (max 512KB)"}), 400
+        return jsonify({"error": "File too large (max 512KB)"}), 413
 
     icons_dir = os.path.join(DATA_DIR, "icons")
     os.makedirs(icons_dir, exist_ok=True)
@@ -1041,9 +1353,11 @@ def upload_icon():
     path = os.path.join(icons_dir, filename)
 
     try:
-        im = Image.open(f).convert("RGBA")
+        im = Image.open(f.stream).convert("RGBA")
         im.thumbnail((MAX_ICON_DIM, MAX_ICON_DIM), Image.LANCZOS)
-        im.save(path, format="PNG")
+        # иконка крошечная и живёт недолго — жмём по-быстрому,
+        # максимальная zlib-компрессия тут пустая трата CPU
+        im.save(path, format="PNG", optimize=False, compress_level=1)
     except Exception:
         return jsonify({"error": "Invalid image"}), 400
 
@@ -1084,22 +1398,52 @@ def dynamic_create():
     return jsonify({"id": id_, "short": short})
 
 
+_dyn_json_lock = threading.Lock()
+_dyn_json_cache: dict = {}
+_dyn_json_mtime: float | None = None
+
+
+def _legacy_dynamic_lookup(id_: str):
+    """
+    Старые динамические коды из dynamic.json. Новые записи давно идут в БД,
+    поэтому файл читается один раз и перечитывается только по смене mtime,
+    а не на каждый редирект.
+    """
+    global _dyn_json_cache, _dyn_json_mtime
+    try:
+        mtime = os.path.getmtime(DYN_PATH)
+    except OSError:
+        return None
+    with _dyn_json_lock:
+        if mtime != _dyn_json_mtime:
+            try:
+                with open(DYN_PATH, "rb") as f:
+                    _dyn_json_cache = orjson.loads(f.read())
+            except Exception:
+                _dyn_json_cache = {}
+            _dyn_json_mtime = mtime
+        return _dyn_json_cache.get(id_)
+
+
 @app.route("/r/<id>")
 def dynamic_redirect(id):
+    # кривые id отсекаем до похода в БД
+    if not _DYN_ID_RE.match(id):
+        return redirect("https://colorqr.app/")
+
     # 1. Сначала пробуем найти в БД (новый формат)
     link = db.session.get(DynamicLink, id)
     if link and link.target_url:
-        return redirect(link.target_url)
+        resp = redirect(link.target_url)
+        # короткий кэш сглаживает всплески сканов; 301 нельзя —
+        # цель динамического кода должна оставаться редактируемой
+        resp.headers["Cache-Control"] = "public, max-age=60"
+        return resp
 
-    # 2. Fallback: старые динамические коды из JSON-файла
-    try:
-        with open(DYN_PATH, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        item = data.get(id)
-        if item and "url" in item:
-            return redirect(item["url"])
-    except Exception:
-        pass
+    # 2. Fallback: старые динамические коды из JSON-файла (кэш в памяти)
+    item = _legacy_dynamic_lookup(id)
+    if item and "url" in item:
+        return redirect(item["url"])
 
     # 3. Если ничего не нашли — ведём просто на главную
     return redirect("https://colorqr.app/")
@@ -1193,6 +1537,71 @@ def dynamic_delete(id):
 
 
 # ---------------------- QR GENERATION ----------------------
+# пул для работы, которую можно делать параллельно с JPG-пайплайном (SVG для Pro)
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="qr-io")
+
+
+@functools.lru_cache(maxsize=256)
+def _render_qr_jpg(raw: str, data_type: str, fill_color: str, back_color: str,
+                   px: int, watermark: bool, quality: int,
+                   custom_icon_path: str | None) -> bytes:
+    """
+    Полный рендер QR → JPG-байты. Все входы в сигнатуре, поэтому функция
+    чистая и кэшируется: повторный запрос с теми же данными/цветами/размером
+    не запускает PIL-пайплайн заново (это основная CPU-стоимость).
+    """
+    # segno собирает матрицу заметно быстрее qrcode при том же ECC H
+    qr = segno.make(raw, error="h")
+
+    # Матрицу модулей красим двухцветным LUT в NumPy (одна векторная операция
+    # вместо make_image + convert("RGBA")), дальше единственный NEAREST-апскейл в C
+    m = np.pad(np.array(qr.matrix, dtype=np.uint8), 4)  # +4 модуля тихой зоны
+    back_rgb = _hex_to_rgb(back_color)
+    fill_rgb = _hex_to_rgb(fill_color)
+    # альфа нужна только оверлеям (ватермарка собирает RGB-кадр сама);
+    # чистый QR держим в RGB — меньше байтов в апскейле, нет сведения альфы
+    needs_alpha = data_type in ("wifi", "vcard")
+    if needs_alpha:
+        lut = np.array([[*back_rgb, 255], [*fill_rgb, 255]], dtype=np.uint8)
+        img = Image.fromarray(lut[m], "RGBA")
+    else:
+        lut = np.array([back_rgb, fill_rgb], dtype=np.uint8)
+        img = Image.fromarray(lut[m], "RGB")
+    img = img.resize((px, px), Image.NEAREST)
+
+    if data_type == "wifi":
+        img = _overlay_wifi_png(img, fill_hex=fill_color, back_hex=back_color)
+    elif data_type == "vcard":
+        img = _overlay_user_png(
+            img,
+            fill_hex=fill_color,
+            back_hex=back_color,
+            custom_icon_path=custom_icon_path
+        )
+
+    if watermark:
+        img = _add_watermark_border(
+            img,
+            text="Created by ColorQR.app",
+            back_hex=back_color,
+            fill_hex=fill_color,
+            font_scale=0.05,
+            margin_scale=0.05,
+            gap_scale=0.05
+        )
+
+    return _save_jpg_from_rgba(img, quality=quality)
+
+
+# карта размеров превью — константа, незачем пересобирать на каждый запрос
+SIZE_PX = {"sm": 256, "md": 512, "lg": 1024}
+
+# верхняя граница ёмкости v40 при ECC H (цифровой режим, 3057 знаков) —
+# грубая отсечка; точный вердикт по режиму кодирования выносит segno,
+# DataOverflowError превращаем в тот же 413
+MAX_QR_PAYLOAD = 3057
+
+
 @app.route("/generate_qr", methods=["POST"])
 def generate_qr():
     payload = request.get_json(force=True, silent=True) or {}
@@ -1210,6 +1619,12 @@ def generate_qr():
     if not raw:
         return jsonify({"error": "Data is required"}), 400
 
+    # лимит проверяем ДО normalize_url: та мемоизирована, и отклонённый
+    # payload не должен оседать ключом в её кэше. Нормализация добавляет
+    # максимум 8 байт схемы — пограничные случаи ловит DataOverflowError
+    if len(raw.encode("utf-8")) > MAX_QR_PAYLOAD:
+        return jsonify({"error": "Data is too long for a QR code"}), 413
+
     if data_type == "url":
         raw = normalize_url(raw)
 
@@ -1229,9 +1644,12 @@ def generate_qr():
         raw = dynamic_short
     # wifi/text/vcard — оставляем raw как есть
 
-
-    fill_color = payload.get("fill_color", "#000000")
-    back_color = payload.get("back_color", "#ffffff")
+    # цвета: канонизируем и отклоняем всё, что не #rgb/#rrggbb — в кэши
+    # должны попадать только короткие валидные ключи
+    fill_color = _safe_hex(payload.get("fill_color", "#000000"))
+    back_color = _safe_hex(payload.get("back_color", "#ffffff"))
+    if fill_color is None or back_color is None:
+        return jsonify({"error": "Invalid color format (expected #rrggbb)"}), 400
 
     size_key = payload.get("size", "md")  # sm | md | lg
     if size_key == "lg" and not is_paid():
@@ -1243,65 +1661,52 @@ def generate_qr():
                 "error": "Color contrast is too low (min 4.5:1 required). Please choose a darker foreground or lighter background for reliable scanning."
             }), 400
 
-    px = {"sm": 256, "md": 512, "lg": 1024}.get(size_key, 512)
-    box = 10 if px >= 512 else 8
+    px = SIZE_PX.get(size_key, 512)
 
-    qr = qrcode.QRCode(
-        version=None,
-        error_correction=qrcode.constants.ERROR_CORRECT_H,
-        box_size=box,
-        border=4
-    )
-    qr.add_data(raw)
-    qr.make(fit=True)
-    img: PilImage = qr.make_image(
-        fill_color=fill_color,
-        back_color=back_color
-    ).convert("RGBA")
+    watermark = not is_paid()
+    quality = 95 if is_one_time() or is_pro() else 92
+    icon_path = session.get("custom_icon_path") if data_type == "vcard" else None
 
-    if data_type == "wifi":
-        img = _overlay_wifi_png(img, fill_hex=fill_color, back_hex=back_color)
-    elif data_type == "vcard" and is_pro():
-        img = _overlay_user_png(
-            img,
-            fill_hex=fill_color,
-            back_hex=back_color,
-            custom_icon_path=session.get("custom_icon_path")
-        )
+    # content-addressed id: одинаковые входы дают один и тот же файл,
+    # повторная генерация не пишет на диск и кэшируется в браузере
+    uid = hashlib.blake2b(
+        f"{raw}|{data_type}|{fill_color}|{back_color}|{px}|{watermark}|{quality}|{icon_path or ''}".encode("utf-8"),
+        digest_size=16,
+    ).hexdigest()
 
-    img = img.resize((px, px), Image.LANCZOS)
+    # SVG (Pro) генерируется параллельно с JPG-пайплайном
+    svg_future = _executor.submit(_gen_svg_bytes, raw, fill_color, back_color) if is_pro() else None
 
-    if not is_paid():
-        img = _add_watermark_border(
-            img,
-            text="Created by ColorQR.app",
-            back_hex=back_color,
-            fill_hex=fill_color,
-            font_scale=0.05,
-            margin_scale=0.05,
-            gap_scale=0.05
+    # --- JPG (кэшируется по всем входам рендера) ---
+    try:
+        jpg_bytes = _render_qr_jpg(
+            raw,
+            data_type,
+            fill_color,
+            back_color,
+            px,
+            watermark=watermark,
+            quality=quality,
+            custom_icon_path=icon_path,
         )
-
-    uid = str(uuid.uuid4())
-
-    # --- JPG ---
-    jpg_bytes = _save_jpg_from_rgba(
-        img,
-        quality=(95 if is_one_time() or is_pro() else 92)
-    )
+    except segno.DataOverflowError:
+        # авторитетная проверка ёмкости — сам кодировщик
+        return jsonify({"error": "Data is too long for a QR code"}), 413
     jpg_path = os.path.join(DATA_DIR, f"{uid}.jpg")
-    with open(jpg_path, "wb") as f:
-        f.write(jpg_bytes)
+    _cache_put(f"{uid}.jpg", jpg_bytes)
+    if not os.path.exists(jpg_path):
+        _write_atomic(jpg_path, jpg_bytes)
 
     # --- SVG (общий, для download_svg) ---
     svg_available = False
     svg_bytes = None
-    if is_pro():
+    if svg_future is not None:
         try:
-            svg_bytes = _gen_svg_bytes(raw, fill_color, back_color)
+            svg_bytes = svg_future.result()
             svg_path = os.path.join(DATA_DIR, f"{uid}.svg")
-            with open(svg_path, "wb") as f:
-                f.write(svg_bytes)
+            _cache_put(f"{uid}.svg", svg_bytes)
+            if not os.path.exists(svg_path):
+                _write_atomic(svg_path, svg_bytes)
             svg_available = True
         except Exception as e:
             app.logger.error(f"SVG generation failed: {e}")
@@ -1311,27 +1716,21 @@ def generate_qr():
     # --- ПЕРСИСТЕНТНЫЕ ФАЙЛЫ ДЛЯ DYNAMIC QR ---
     if data_type == "dynamic" and dynamic_id:
         try:
-            # JPG под id динамической ссылки
-            dyn_jpg_path = os.path.join(DYNAMIC_QR_DIR, f"{dynamic_id}.jpg")
-            with open(dyn_jpg_path, "wb") as f_dyn_jpg:
-                f_dyn_jpg.write(jpg_bytes)
+            # JPG под id динамической ссылки — хардлинк на уже записанный файл
+            _link_or_write(jpg_path, os.path.join(DYNAMIC_QR_DIR, f"{dynamic_id}.jpg"), jpg_bytes)
 
             # SVG под id динамической ссылки
             if svg_bytes is not None:
-                dyn_svg_path = os.path.join(DYNAMIC_QR_DIR, f"{dynamic_id}.svg")
-                with open(dyn_svg_path, "wb") as f_dyn_svg:
-                    f_dyn_svg.write(svg_bytes)
+                _link_or_write(svg_path, os.path.join(DYNAMIC_QR_DIR, f"{dynamic_id}.svg"), svg_bytes)
         except Exception as e:
             app.logger.error(f"Failed to persist dynamic QR files for {dynamic_id}: {e}")
 
     # --- ответ клиенту ---
-    b64 = base64.b64encode(jpg_bytes).decode("utf-8")
-
     download_name = _build_download_name(data_type, raw)
     session["download_name"] = download_name
 
     return jsonify({
-        "qr_code": b64,
+        "qr_url": url_for("qr_image", uid=uid),
         "id": uid,
         "svg_available": svg_available,
         "dynamic_id": dynamic_id,
@@ -1339,16 +1738,143 @@ def generate_qr():
     })
 
 
+@app.route("/generate_qr_batch", methods=["POST"])
+def generate_qr_batch():
+    """
+    Пакетная генерация (bulk vCards, кампании): валидация и статус-чтения
+    из сессии делаются один раз, рендеры уходят в общий пул потоков и
+    амортизируют прогретые кэши (бейджи, ватермарка, иконки).
+    Dynamic-коды не поддерживаются — им нужна запись в БД на каждый элемент.
+    """
+    payload = request.get_json(force=True, silent=True) or {}
+    items = payload.get("items")
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "items list required"}), 400
+    if len(items) > 50:
+        return jsonify({"error": "Too many items (max 50)"}), 400
+
+    pro = is_pro()
+    paid = is_paid()
+    watermark = not paid
+    quality = 95 if paid else 92
+
+    def _prep(item):
+        """Возвращает (args для _render_qr_jpg, error)."""
+        data_type = (item.get("data_type") or "url").lower()
+        raw = (item.get("data") or "").strip()
+        if data_type == "dynamic":
+            return None, "Dynamic QR is not supported in batch"
+        if data_type == "vcard" and not pro:
+            return None, "vCard available in Pro"
+        if not raw:
+            return None, "Data is required"
+        # лимит до мемоизированной normalize_url — отклонённый payload
+        # не должен застревать в её кэше (пограничное +8 байт схемы
+        # страхует DataOverflowError ниже)
+        if len(raw.encode("utf-8")) > MAX_QR_PAYLOAD:
+            return None, "Data is too long for a QR code"
+        if data_type == "url":
+            raw = normalize_url(raw)
+
+        fill = _safe_hex(item.get("fill_color", "#000000"))
+        back = _safe_hex(item.get("back_color", "#ffffff"))
+        if fill is None or back is None:
+            return None, "Invalid color format (expected #rrggbb)"
+        size_key = item.get("size", "md")
+        if size_key == "lg" and not paid:
+            size_key = "md"
+        if paid and not _check_contrast(fill, back, min_ratio=4.5):
+            return None, "Color contrast is too low (min 4.5:1 required)"
+
+        px = SIZE_PX.get(size_key, 512)
+        return (raw, data_type, fill, back, px), None
+
+    prepped = [_prep(item) for item in items]
+    futures = {}
+    for i, (args, err) in enumerate(prepped):
+        if args is not None:
+            raw, data_type, fill, back, px = args
+            futures[i] = _executor.submit(
+                _render_qr_jpg, raw, data_type, fill, back, px,
+                watermark=watermark, quality=quality, custom_icon_path=None,
+            )
+
+    results = []
+    for i, (args, err) in enumerate(prepped):
+        if args is None:
+            results.append({"error": err})
+            continue
+        raw, data_type, fill, back, px = args
+        try:
+            jpg_bytes = futures[i].result()
+        except segno.DataOverflowError:
+            results.append({"error": "Data is too long for a QR code"})
+            continue
+        except Exception as e:
+            app.logger.error(f"Batch QR render failed: {e}")
+            results.append({"error": "Render failed"})
+            continue
+
+        uid = hashlib.blake2b(
+            f"{raw}|{data_type}|{fill}|{back}|{px}|{watermark}|{quality}|".encode("utf-8"),
+            digest_size=16,
+        ).hexdigest()
+        jpg_path = os.path.join(DATA_DIR, f"{uid}.jpg")
+        _cache_put(f"{uid}.jpg", jpg_bytes)
+        if not os.path.exists(jpg_path):
+            _write_atomic(jpg_path, jpg_bytes)
+        results.append({"id": uid, "qr_url": url_for("qr_image", uid=uid)})
+
+    return jsonify({"results": results})
+
+
 # ---------------------- DOWNLOADS ----------------------
+# id приходят от клиента и попадают в пути файлов — валидируем форму
+# до любых syscall'ов (заодно закрывает ../-traversal)
+_UID_RE = re.compile(r"\A[0-9a-f]{32}\Z")
+# новые id — url-safe base64, старые — hex-срезы; оба ровно 8 символов
+_DYN_ID_RE = re.compile(r"\A[0-9A-Za-z_-]{8}\Z")
+
+
+@app.route("/qr/<uid>.jpg")
+def qr_image(uid):
+    """
+    Превью QR как обычная картинка. uid уникален для каждой генерации,
+    поэтому можно отдавать с длинным Cache-Control + ETag (304 на повторе),
+    а ответ /generate_qr не таскает base64-пейлоад.
+    """
+    if not _UID_RE.match(uid):
+        return "Not found", 404
+    path = os.path.join(DATA_DIR, f"{uid}.jpg")
+    if not os.path.exists(path):
+        return "Not found", 404
+    resp = send_file(path, mimetype="image/jpeg", conditional=True, max_age=31536000)
+    # uid — хэш содержимого: картинка под этим URL не меняется никогда,
+    # так что immutable избавляет браузер даже от ревалидаций
+    resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return resp
+
+
 @app.route("/download_jpg")
 def download_jpg():
     file_id = request.args.get("id")
     if not file_id:
         return "Missing id", 400
+    if not _UID_RE.match(file_id):
+        return "Not found", 404
 
     # раньше было pop → имя терялось для второго скачивания
     download_name = session.get("download_name", "qrcode")
 
+    cached = _cache_get(f"{file_id}.jpg")
+    if cached is not None:
+        return send_file(
+            BytesIO(cached),
+            as_attachment=True,
+            download_name=f"{download_name}.jpg",
+            mimetype="image/jpeg"
+        )
+
     path = os.path.join(DATA_DIR, f"{file_id}.jpg")
     if not os.path.exists(path):
         return "Not found", 404
@@ -1356,7 +1882,8 @@ def download_jpg():
         path,
         as_attachment=True,
         download_name=f"{download_name}.jpg",
-        mimetype="image/jpeg"
+        mimetype="image/jpeg",
+        conditional=True,
     )
 
 @app.route("/dynamic/qr/<id>.jpg")
@@ -1365,10 +1892,12 @@ def dynamic_qr_image(id):
     Постоянная картинка JPG для динамического кода (по его id).
     Открывается в браузере.
     """
+    if not _DYN_ID_RE.match(id):
+        return "Not found", 404
     path = os.path.join(DYNAMIC_QR_DIR, f"{id}.jpg")
     if not os.path.exists(path):
         return "Not found", 404
-    return send_file(path, mimetype="image/jpeg")
+    return send_file(path, mimetype="image/jpeg", conditional=True)
 
 
 @app.route("/dynamic/qr/<id>.svg")
@@ -1378,6 +1907,8 @@ def dynamic_qr_svg(id):
     """
     if not is_pro():
         return "Pro required", 403
+    if not _DYN_ID_RE.match(id):
+        return "Not found", 404
 
     path = os.path.join(DYNAMIC_QR_DIR, f"{id}.svg")
     if not os.path.exists(path):
@@ -1387,7 +1918,8 @@ def dynamic_qr_svg(id):
         path,
         as_attachment=True,
         download_name=f"dynamic-{id}.svg",
-        mimetype="image/svg+xml"
+        mimetype="image/svg+xml",
+        conditional=True,
     )
 
 
@@ -1400,10 +1932,21 @@ def download_svg():
     file_id = request.args.get("id")
     if not file_id:
         return "Missing id", 400
+    if not _UID_RE.match(file_id):
+        return "Not found", 404
 
     # тоже get вместо pop
     download_name = session.get("download_name", "qrcode")
 
+    cached = _cache_get(f"{file_id}.svg")
+    if cached is not None:
+        return send_file(
+            BytesIO(cached),
+            as_attachment=True,
+            download_name=f"{download_name}.svg",
+            mimetype="image/svg+xml"
+        )
+
     path = os.path.join(DATA_DIR, f"{file_id}.svg")
     if not os.path.exists(path):
         return "Not found", 404
@@ -1412,7 +1955,8 @@ def download_svg():
         path,
         as_attachment=True,
         download_name=f"{download_name}.svg",
-        mimetype="image/svg+xml"
+        mimetype="image/svg+xml",
+        conditional=True,
     )
 
 